@@ -1,49 +1,88 @@
 #!/usr/bin/env python
 
 from __future__ import unicode_literals
+import array
 import datetime
+import heapq
+from itertools import chain
 import json
 import math
+import os
 from pprint import pformat
 import random
-import select
+import selectors
 import sys
 import time
 import traceback
 
+# JSON codec: orjson is several times faster than the stdlib at both
+# encoding and decoding, but we fall back to the stdlib so this demo still
+# runs anywhere. Both dumps and loads work in terms of bytes.
+try:
+    from orjson import dumps, loads, Fragment
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj).encode()
+    loads = json.loads
+    Fragment = None
+
 # Utilities
 
+# How much do we log? 0: nothing, 1: interesting events, 2: every message.
+# Pretty-printing every message through pformat is expensive, so trace-level
+# call sites check LOG_LEVEL themselves before building the log string.
+LOG_LEVEL = int(os.environ.get('MAELSTROM_LOG', '1'))
+
 def log(*args):
     """Helper function for logging stuff to stderr"""
-    sys.stderr.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f "))
-    for i in range(len(args)):
-        sys.stderr.write(str(args[i]))
-        if i < (len(args) - 1):
-            sys.stderr.write(" ")
-    sys.stderr.write('\n')
+    if LOG_LEVEL < 1:
+        return
+    # Build the whole line first and write it in one call, so lines stay
+    # intact and we don't pay a write per field.
+    sys.stderr.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f ")
+                     + ' '.join(map(str, args)) + '\n')
 
 def majority(n):
     """What number would constitute a majority of n nodes?"""
     return int(math.floor((n / 2.0) + 1))
 
-def median(xs):
-    """Given a collection of elements, finds the median, biasing towards lower values if there's a tie."""
-    xs = list(xs)
-    xs.sort()
-    return xs[len(xs) - majority(len(xs))]
-
 class Net():
     """Handles console IO for sending and receiving messages."""
 
+    # These classes have fixed attribute sets, so declare them: slotted
+    # instances skip the per-object __dict__ and make attribute reads on
+    # the hot paths a bit cheaper.
+    __slots__ = ('node_id', 'src_prefix', 'next_msg_id', 'handlers',
+                 'callbacks', 'cb_base', 'in_buf', 'out', 'out_len')
+
     def __init__(self):
         """Constructs a new network client."""
         self.node_id = None     # Our local node ID
+        self.src_prefix = b'{"src":null,"dest":"' # Envelope prefix, rebuilt
+                                                  # once we learn our ID
         self.next_msg_id = 0    # The next message ID we're going to allocate
         self.handlers = {}      # A map of message types to handler functions
-        self.callbacks = {}     # A map of message IDs to response handlers
+        # Response handlers, indexed by message ID. Since we allocate message
+        # IDs densely, these live in a list: entry i holds the handler for
+        # message ID cb_base + i, and consumed entries are trimmed off the
+        # front as they're used up.
+        self.callbacks = []
+        self.cb_base = 0        # The message ID of callbacks[0]
+        self.in_buf = bytearray() # Buffered, but not yet parsed, stdin bytes
+        # Serialized messages awaiting a flush live in one preallocated,
+        # reusable buffer; out_len tracks how much of it is filled.
+        self.out = bytearray(1 << 16)
+        self.out_len = 0
+        # We read stdin in bulk, rather than line by line, so we can drain the
+        # OS pipe buffer in a single syscall.
+        os.set_blocking(0, False)
 
     def set_node_id(self, id):
         self.node_id = id
+        # Every message we originate shares the same envelope shape, and
+        # node IDs never need JSON escaping, so we can prebuild the envelope
+        # prefix once and splice bytes instead of building a dict per send.
+        self.src_prefix = b'{"src":"' + id.encode() + b'","dest":"'
 
     def new_msg_id(self):
         """Generate a fresh message ID"""
@@ -58,154 +97,272 @@ class Net():
 
         self.handlers[msg_type] = handler
 
+    def enqueue(self, line):
+        """Appends one serialized, newline-terminated message to the output
+        buffer. Messages are buffered, and actually written to stdout by
+        flush(), so that one main-loop tick issues a single write for all
+        the messages it produced."""
+        needed = self.out_len + len(line)
+        if len(self.out) < needed:
+            self.out.extend(b'\0' * (needed - len(self.out)))
+        self.out[self.out_len : needed] = line
+        self.out_len = needed
+
     def send_msg(self, msg):
-        """Sends a raw message object"""
-        log('Sent\n' + pformat(msg))
-        json.dump(msg, sys.stdout)
-        sys.stdout.write('\n')
-        sys.stdout.flush()
+        """Enqueues a raw message object."""
+        if LOG_LEVEL >= 2:
+            log('Sent\n' + pformat(msg))
+        self.enqueue(dumps(msg) + b'\n')
+
+    def flush(self):
+        """Writes all buffered outbound messages to stdout in one go."""
+        if self.out_len:
+            view = memoryview(self.out)[0:self.out_len]
+            written = 0
+            while written < self.out_len:
+                written += os.write(1, view[written:])
+            self.out_len = 0
 
     def send(self, dest, body):
-        """Sends a message to the given destination node with the given body."""
-        self.send_msg({'src': self.node_id, 'dest': dest, 'body': body})
+        """Sends a message to the given destination node with the given
+        body, splicing the body's bytes into our prebuilt envelope prefix."""
+        if LOG_LEVEL >= 2:
+            log('Sent\n' + pformat({'src': self.node_id,
+                                    'dest': dest,
+                                    'body': body}))
+        self.enqueue(self.src_prefix + dest.encode() + b'","body":' +
+                     dumps(body) + b'}\n')
 
     def reply(self, req, body):
         """Replies to a given request message with a response body."""
         body['in_reply_to'] = req['body']['msg_id']
         self.send(req['src'], body)
 
-    def rpc(self, dest, body, handler):
-        """Sends an RPC request to dest and handles the response with handler."""
+    def rpc(self, dest, body, handler, ctx=None):
+        """Sends an RPC request to dest and handles the response with
+        handler. An optional ctx is passed through to the handler, which lets
+        callers use one shared function instead of allocating a closure per
+        request."""
         msg_id = self.new_msg_id()
-        self.callbacks[msg_id] = handler
+        # Message IDs are dense, so this lands at index msg_id - cb_base
+        self.callbacks.append((handler, ctx))
         body['msg_id'] = msg_id
         self.send(dest, body)
 
-    def process_msg(self):
-        """Handles a message from stdin, if one is currently available."""
-        if sys.stdin not in select.select([sys.stdin], [], [], 0)[0]:
-            return None
-
-        line = sys.stdin.readline()
-        if not line:
-            return None
+    def expire_callbacks(self):
+        """Drops every outstanding reply callback. Callers invoke this once
+        they've presumed the underlying requests lost or stale, so a reply
+        that never arrives can't pin the head of the callback list forever;
+        any reply that does straggle in is ignored by handle_msg."""
+        self.cb_base += len(self.callbacks)
+        del self.callbacks[:]
 
-        msg = json.loads(line)
-        log("Received\n" + pformat(msg))
+    def process_msg(self):
+        """Handles all messages currently waiting on stdin, if any are
+        available."""
+        try:
+            chunk = os.read(0, 65536)
+        except BlockingIOError:
+            # No data waiting
+            chunk = b''
+        if chunk:
+            self.in_buf.extend(chunk)
+
+        # Pull every complete line out of the buffer, and handle each one.
+        handled = None
+        while True:
+            newline = self.in_buf.find(b'\n')
+            if newline == -1:
+                return handled
+
+            line = bytes(self.in_buf[0:newline])
+            del self.in_buf[0:newline + 1]
+            self.handle_msg(loads(line))
+            handled = True
+
+    def handle_msg(self, msg):
+        """Dispatches a single parsed message to its callback or handler."""
+        if LOG_LEVEL >= 2:
+            log("Received\n" + pformat(msg))
         body = msg['body']
 
-        handler = None
         # Look up reply handler
-        if 'in_reply_to' in body:
-            m = body['in_reply_to']
-            handler = self.callbacks[m]
-            del self.callbacks[m]
+        m = body.get('in_reply_to')
+        if m is not None:
+            i = m - self.cb_base
+            entry = (self.callbacks[i]
+                     if 0 <= i < len(self.callbacks) else None)
+            if entry is None:
+                # Already answered, or expired by expire_callbacks
+                log('Ignoring reply to', m, 'with no callback')
+                return
+            handler, ctx = entry
+            self.callbacks[i] = None
+            # Trim the consumed prefix, so the list tracks only
+            # still-outstanding RPCs
+            n = 0
+            while n < len(self.callbacks) and self.callbacks[n] is None:
+                n += 1
+            if n:
+                del self.callbacks[0:n]
+                self.cb_base += n
+            if ctx is None:
+                handler(msg)
+            else:
+                handler(msg, ctx)
 
         # Fall back based on message type
-        elif body['type'] in self.handlers:
-            handler = self.handlers[body['type']]
-
         else:
-            raise RuntimeError('No callback or handler for\n' + pformat(msg))
+            handler = self.handlers.get(body['type'])
+            if handler is None:
+                raise RuntimeError('No callback or handler for\n' + pformat(msg))
+            handler(msg)
 
-        handler(msg)
-        return True
+# How many entries will we ship in a single append_entries message? Bounding
+# this keeps a lagging follower from forcing one enormous RPC; it catches up
+# in chunks over successive replication passes instead.
+MAX_ENTRIES_PER_APPEND = 256
+
+# How many append_entries RPCs may be outstanding to one follower before we
+# stop sending it more? A small cap pipelines nicely without flooding a slow
+# node.
+MAX_INFLIGHT_APPENDS = 2
 
 class Log():
-    """Stores Raft entries, which are dicts with a :term field."""
+    """Stores Raft entries: on the wire these are dicts with :term and :op
+    fields, but internally we keep terms and ops in parallel lists, so the
+    hot term lookups are plain list indexing rather than dict derefs."""
+
+    __slots__ = ('terms', 'ops', '_size', '_last_term')
 
     def __init__(self):
         """Construct a new Log"""
         # Note that we provide a default entry here, which simplifies
         # some default cases involving empty logs.
-        self.entries = [{'term': 0, 'op': None}]
-
-    def get(self, i):
-        """Return a log entry by index. Note that Raft's log is 1-indexed."""
-        return self.entries[i - 1]
+        self.terms = [0]
+        self.ops = [None]
+        # Cached size and last term, maintained by append and truncate, so
+        # the hot paths read plain attributes.
+        self._size = 1
+        self._last_term = 0
+
+    def term_at(self, i):
+        """The term of the log entry at index i. Note that Raft's log is
+        1-indexed."""
+        return self.terms[i - 1]
+
+    def op_at(self, i):
+        """The op of the log entry at index i."""
+        return self.ops[i - 1]
 
     def append(self, entries):
-        """Appends multiple entries to the log."""
-        self.entries.extend(entries)
-        #log("Log:\n" + pformat(self.entries))
-
-    def last(self):
-        """Returns the most recent entry"""
-        return self.entries[-1]
+        """Appends multiple wire-format entries to the log."""
+        for e in entries:
+            self.terms.append(e['term'])
+            self.ops.append(e['op'])
+        self._size = len(self.terms)
+        self._last_term = self.terms[-1]
 
     def last_term(self):
         "What's the term of the last entry in the log?"
-        l = self.last()
-        if l:
-            return l['term']
-        else:
-            return 0
+        return self._last_term
 
     def size(self):
         "How many entries are in the log?"
-        return len(self.entries)
+        return self._size
 
     def truncate(self, size):
         """Truncate the log to this many entries."""
-        self.entries = self.entries[0:size]
+        del self.terms[size:]
+        del self.ops[size:]
+        self._size = len(self.terms)
+        self._last_term = self.terms[-1]
 
     def from_index(self, i):
-        "All entries from index i on"
+        """Wire-format entries from index i on, up to
+        MAX_ENTRIES_PER_APPEND of them."""
         if i <= 0:
             raise LookupError('illegal index ' + i)
-        return self.entries[i - 1:]
+        return [{'term': t, 'op': o}
+                for t, o in zip(self.terms[i - 1 : i - 1 + MAX_ENTRIES_PER_APPEND],
+                                self.ops[i - 1 : i - 1 + MAX_ENTRIES_PER_APPEND])]
 
 class KVStore():
     """A state machine providing a key-value store."""
+    __slots__ = ('state',)
+
     def __init__(self):
         self.state = {}
 
-    def apply(self, op):
-        """Applies an op to the state machine, and returns a response message."""
-        t = op['type']
+    def _op_read(self, op):
         k = op['key']
+        if k in self.state:
+            return {'type': 'read_ok', 'value': self.state[k]}
+        else:
+            return {'type': 'error', 'code': 20, 'text': 'not found'}
+
+    def _op_write(self, op):
+        self.state[op['key']] = op['value']
+        return {'type': 'write_ok'}
 
+    def _op_cas(self, op):
+        k = op['key']
+        if k not in self.state:
+            return {'type': 'error', 'code': 20, 'text': 'not found'}
+        elif self.state[k] != op['from']:
+            return {
+                'type': 'error',
+                'code': 22,
+                'text': 'expected ' + str(op['from']) + ' but had ' + str(self.state[k])
+                }
+        else:
+            self.state[k] = op['to']
+            return {'type': 'cas_ok'}
+
+    # Dispatch table from op types to handler methods
+    _OPS = {'read': _op_read, 'write': _op_write, 'cas': _op_cas}
+
+    def apply(self, op):
+        """Applies an op to the state machine, and returns a response message."""
         # Handle state transition
-        if t == 'read':
-            if k in self.state:
-                res = {'type': 'read_ok', 'value': self.state[k]}
-            else:
-                res = {'type': 'error', 'code': 20, 'text': 'not found'}
-        elif t == 'write':
-            self.state[k] = op['value']
-            res = {'type': 'write_ok'}
-        elif t == 'cas':
-            if k not in self.state:
-                res = {'type': 'error', 'code': 20, 'text': 'not found'}
-            elif self.state[k] != op['from']:
-                res = {
-                    'type': 'error',
-                    'code': 22,
-                    'text': 'expected ' + str(op['from']) + ' but had ' + str(self.state[k])
-                    }
-            else:
-                self.state[k] = op['to']
-                res = {'type': 'cas_ok'}
+        res = self._OPS[op['type']](self, op)
 
-        log('KV:\n' + pformat(self.state))
+        if LOG_LEVEL >= 2:
+            log('KV:\n' + pformat(self.state))
 
         # Construct response
         res['in_reply_to'] = op['msg_id']
         return {'dest': op['client'], 'body': res}
 
 class RaftNode():
+    __slots__ = ('now', 'election_timeout', 'heartbeat_interval',
+                 'min_replication_interval', 'election_deadline',
+                 'step_down_deadline', 'last_replication',
+                 'node_id', 'node_ids', '_other_nodes', 'peer_idx', 'quorum',
+                 'state', 'current_term', 'voted_for', 'commit_index',
+                 'last_applied', 'leader', 'last_leader_contact',
+                 'pending_ops', 'next_index', '_match_index', 'inflight',
+                 'lease_acks', 'term_start_index', 'net', 'log',
+                 'state_machine')
+
     def __init__(self):
-        # Heartbeats & timeouts
+        # Heartbeats & timeouts. Times are monotonic-clock seconds; rather
+        # than asking the clock in every predicate, the main loop caches one
+        # reading per tick in self.now, and everything else reads that.
+        self.now = time.monotonic()     # Cached clock reading for this tick
         self.election_timeout = 2       # Time before election, in seconds
         self.heartbeat_interval = 1     # Time between heartbeats, in seconds
         self.min_replication_interval = 0.05	# Don't replicate TOO frequently
-        self.election_deadline = 0      # Next election, in epoch seconds
+        self.election_deadline = 0      # Next election
         self.step_down_deadline = 0     # When to step down automatically
-        self.last_replication = 0       # Last replication, in epoch seconds
+        self.last_replication = 0       # Last replication
 
         # Node & cluster IDS
         self.node_id = None     # Our node ID
         self.node_ids = None    # List of all node IDs
+        self._other_nodes = () # Every node but us, cached once at init
+        self.peer_idx = {}     # Map of peer node IDs to dense array indices
+        self.quorum = 1        # How many nodes make a majority?
 
         # Raft state
         self.state = 'nascent'  # One of nascent, follower, candidate, or leader
@@ -214,11 +371,24 @@ class RaftNode():
         self.commit_index = 0   # The index of the highest committed entry
         self.last_applied = 1   # The last entry we applied to the state machine
         self.leader = None	# Who do we think the leader is?
-
-        # Leader state
-        self.next_index = None   # A map of nodes to the next index to replicate
-        self._match_index = None # Map of nodes to the highest log entry known
-                                 # to be replicated on that node.
+        self.last_leader_contact = float('-inf') # When we last heard from a
+                                # valid leader; we withhold votes for an
+                                # election timeout after this.
+        self.pending_ops = []   # Client ops awaiting a log entry; each tick's
+                                # arrivals share one entry.
+
+        # Leader state: all int arrays indexed by peer_idx.
+        self.next_index = None   # Per-peer next index to replicate
+        self._match_index = None # Per-peer highest log entry known to be
+                                 # replicated on that node.
+        self.inflight = None     # Per-peer count of unanswered
+                                 # append_entries RPCs
+        self.lease_acks = None   # Per-peer send time of the latest
+                                 # acknowledged append_entries; these back
+                                 # the read lease.
+        self.term_start_index = None # Index of the no-op we append on
+                                 # taking office; no lease reads until it
+                                 # commits.
 
         # Components
         self.net = Net()
@@ -228,15 +398,7 @@ class RaftNode():
 
     def other_nodes(self):
         """All nodes except this one."""
-        nodes = list(self.node_ids)
-        nodes.remove(self.node_id)
-        return nodes
-
-    def match_index(self):
-        """Returns the map of match indices, including an entry for ourselves, based on our log size."""
-        m = dict(self._match_index)
-        m[self.node_id] = self.log.size()
-        return m
+        return self._other_nodes
 
     def set_node_id(self, id):
         """Assign our node ID."""
@@ -250,11 +412,11 @@ class RaftNode():
 
     def reset_election_deadline(self):
         """Don't start an election for a little while."""
-        self.election_deadline = time.time() + (self.election_timeout * (random.random() + 1))
+        self.election_deadline = self.now + (self.election_timeout * (random.random() + 1))
 
     def reset_step_down_deadline(self):
         """Don't step down for a while."""
-        self.step_down_deadline = time.time() + self.election_timeout
+        self.step_down_deadline = self.now + self.election_timeout
 
     def advance_term(self, term):
         """Advance our term to `term`, resetting who we voted for."""
@@ -274,11 +436,13 @@ class RaftNode():
     def request_votes(self):
         """Request that other nodes vote for us as a leader"""
 
-        # We vote for ourself
-        votes = set([self.node_id])
+        # We track votes as a bitmask with one bit per node: peers get their
+        # peer_idx bit, and we take the bit above those for our own vote.
+        votes = 1 << len(self.other_nodes())
         term = self.current_term
 
         def handle(response):
+            nonlocal votes
             self.reset_step_down_deadline()
             body = response['body']
             self.maybe_step_down(body['term'])
@@ -289,10 +453,11 @@ class RaftNode():
                     body['vote_granted']:
 
                 # We have a vote for our candidacy
-                votes.add(response['src'])
-                log('Have votes:', pformat(votes))
+                votes |= 1 << self.peer_idx[response['src']]
+                if LOG_LEVEL >= 2:
+                    log('Have votes:', bin(votes))
 
-                if majority(len(self.node_ids)) <= len(votes):
+                if self.quorum <= votes.bit_count():
                     # We have a majority of votes for this term
                     self.become_leader()
 
@@ -302,7 +467,7 @@ class RaftNode():
             'term':             self.current_term,
             'candidate_id':     self.node_id,
             'last_log_index':   self.log.size(),
-            'last_log_term':    self.log.last()['term']
+            'last_log_term':    self.log.last_term()
             },
             handle)
 
@@ -313,7 +478,13 @@ class RaftNode():
         self.state = 'follower'
         self.next_index = None
         self._match_index = None
+        self.inflight = None
+        self.lease_acks = None
+        self.term_start_index = None
         self.leader = None
+        # Ops we never got into the log are abandoned, like any other
+        # uncommitted entry; their clients will time out and retry.
+        self.pending_ops = []
         self.reset_election_deadline()
         log('Became follower for term', self.current_term)
 
@@ -325,6 +496,9 @@ class RaftNode():
         self.leader = None
         self.reset_election_deadline()
         self.reset_step_down_deadline()
+        # Replies to RPCs from earlier terms are stale now; drop their
+        # callbacks rather than waiting on replies that may never come.
+        self.net.expire_callbacks()
         log('Became candidate for term', self.current_term)
         self.request_votes()
 
@@ -336,32 +510,54 @@ class RaftNode():
         self.state = 'leader'
         self.leader = None
         self.last_replication = 0 # Start replicating immediately
-        # We'll start by trying to replicate our most recent entry
-        self.next_index = {n: self.log.size() + 1 for n in self.other_nodes()}
-        self._match_index = {n: 0 for n in self.other_nodes()}
+        # Commit something from our own term right away: commit_index can't
+        # move past an older term's entries until an entry of ours commits,
+        # so we append a no-op and hold off lease reads until it's in.
+        self.log.append([{'term': self.current_term, 'op': None}])
+        self.term_start_index = self.log.size()
+        # We'll start by trying to replicate from that no-op
+        n_peers = len(self.other_nodes())
+        self.next_index = array.array('q', [self.term_start_index] * n_peers)
+        self._match_index = array.array('q', [0] * n_peers)
+        self.inflight = array.array('q', [0] * n_peers)
+        self.lease_acks = array.array('d', [float('-inf')] * n_peers)
         self.reset_step_down_deadline()
         log('Became leader for term', self.current_term)
 
     # Actions for all nodes
 
+    def append_pending_ops(self):
+        """If we're the leader, fold the client ops that arrived this tick
+        into a single log entry for replication."""
+        if self.pending_ops and self.state == 'leader':
+            self.log.append([{'term': self.current_term,
+                              'op': self.pending_ops}])
+            self.pending_ops = []
+            return True
+
     def advance_state_machine(self):
-        """If we have unapplied committed entries in the log, apply one to the state machine."""
-        if self.last_applied < self.commit_index:
-            # Advance the applied index and apply that op
+        """If we have unapplied committed entries in the log, apply them all
+        to the state machine."""
+        advanced = None
+        while self.last_applied < self.commit_index:
+            # Advance the applied index and apply that entry's batch of ops
             self.last_applied += 1
-            res = self.state_machine.apply(self.log.get(self.last_applied)['op'])
-            if self.state == 'leader':
-                # We were the leader, let's respond to the client.
-                self.net.send(res['dest'], res['body'])
+            batch = self.log.op_at(self.last_applied)
+            if batch:
+                for op in batch:
+                    res = self.state_machine.apply(op)
+                    if self.state == 'leader':
+                        # We were the leader, let's respond to the client.
+                        self.net.send(res['dest'], res['body'])
+            advanced = True
 
-        # We did something!
-        return True
+        return advanced
 
     # Actions for followers/candidates
 
     def election(self):
         """If it's been long enough, trigger a leader election."""
-        if self.election_deadline < time.time():
+        if self.election_deadline < self.now:
             if self.state == 'follower' or self.state == 'candidate':
                 # Let's go!
                 self.become_candidate()
@@ -374,25 +570,85 @@ class RaftNode():
 
     def step_down_on_timeout(self):
         """If we haven't received any acks for a while, step down."""
-        if self.state == 'leader' and self.step_down_deadline < time.time():
+        if self.state == 'leader' and self.step_down_deadline < self.now:
             log("Stepping down: haven't received any acks recently")
             self.become_follower()
             return True
 
+    def lease_valid(self):
+        """Do we hold a read lease? True iff a majority of the cluster,
+        counting ourselves, acked append_entries we sent within the last
+        election timeout. Those followers withhold votes for an election
+        timeout after (no earlier than) the send, so no new leader can
+        commit a write behind our back before the lease runs out."""
+        if self.commit_index < self.term_start_index:
+            # Our term's no-op hasn't committed yet, so commit_index may
+            # still trail writes the previous leader acked; reads have to
+            # take the log path until it does.
+            return False
+        if self.quorum <= 1:
+            return True
+        # The quorum-th freshest ack, counting our own always-current slot,
+        # is the (quorum - 1)-th freshest among peers.
+        t = heapq.nlargest(self.quorum - 1, self.lease_acks)[-1]
+        return self.now < t + self.election_timeout
+
     def advance_commit_index(self):
         """If we're the leader, advance our commit index based on what other nodes match us."""
         if self.state == 'leader':
-            n = median(self.match_index().values())
-            if self.commit_index < n and self.log.get(n)['term'] == self.current_term:
+            # Find the highest index replicated on a majority of nodes: the
+            # quorum-th largest match index (counting our own log size as
+            # our own match index) is the highest index a majority shares.
+            n = heapq.nlargest(self.quorum,
+                               chain(self._match_index,
+                                     (self.log.size(),)))[-1]
+            if self.commit_index < n and self.log.term_at(n) == self.current_term:
                 log("Commit index now", n)
                 self.commit_index = n
                 return True
 
+    def handle_append_entries_res(self, res, ctx):
+        """Handles one follower's response to an append_entries RPC. ctx is
+        the (peer index, next index, entry count, node, term, send time)
+        tuple recorded when the RPC was sent."""
+        i, ni, n_entries, node, term, sent_at = ctx
+        body = res['body']
+        self.maybe_step_down(body['term'])
+        if self.state == 'leader' and term == self.current_term:
+            self.reset_step_down_deadline()
+            if 0 < self.inflight[i]:
+                self.inflight[i] -= 1
+            if body['success']:
+                # The lease clock runs from when we *sent* the RPC: that
+                # bounds when the follower received it and restarted its
+                # election timer.
+                if self.lease_acks[i] < sent_at:
+                    self.lease_acks[i] = sent_at
+                self.next_index[i] = \
+                        max(self.next_index[i], ni + n_entries)
+                self._match_index[i] = \
+                        max(self._match_index[i], ni - 1 + n_entries)
+                if LOG_LEVEL >= 2:
+                    log("node", node, "# entries", n_entries, "ni", ni)
+                    log("next index:", pformat(self.next_index))
+            elif 'conflict_index' in body:
+                # Accelerated backtracking: jump straight to the follower's
+                # reported conflict point rather than probing back one entry
+                # per round trip. Rewind relative to the RPC that failed,
+                # not the (optimistically advanced) current next index:
+                # pipelined failures would otherwise each walk it back one
+                # more step than the follower asked for. Index 1 is the
+                # sentinel entry every log shares, so 2 is the floor.
+                self.next_index[i] = max(2, min(ni - 1,
+                                                body['conflict_index']))
+            else:
+                self.next_index[i] = max(2, ni - 1)
+
     def replicate_log(self):
         """If we're the leader, replicate unacknowledged log entries to followers. Also serves as a heartbeat."""
 
         # How long has it been since we replicated?
-        elapsed_time = time.time() - self.last_replication
+        elapsed_time = self.now - self.last_replication
         # We'll set this to true if we replicate to anyone
         replicated = False
         # We'll need this to make sure we process responses in *this* term
@@ -400,48 +656,69 @@ class RaftNode():
 
         if self.state == 'leader' and self.min_replication_interval < elapsed_time:
             # We're a leader, and enough time elapsed
-            for node in self.other_nodes():
-                # What entries should we send this node?
-                ni = self.next_index[node]
-                entries = self.log.from_index(ni)
-                if 0 < len(entries) or self.heartbeat_interval < elapsed_time:
-                    log('replicating ' + str(ni) + '+ to', node)
-
-
-                    # "closure"
-                    _ni = ni
-                    _entries = list(entries)
-                    _node = node
-
-                    def handler(res):
-                        body = res['body']
-                        self.maybe_step_down(body['term'])
-                        if self.state == 'leader' and term == self.current_term:
-                            self.reset_step_down_deadline()
-                            if body['success']:
-                                self.next_index[_node] = \
-                                        max(self.next_index[_node], _ni + len(_entries))
-                                self._match_index[_node] = \
-                                        max(self._match_index[_node], _ni - 1 + len(_entries))
-                                log("node", _node, "# entries", len(_entries), "ni", ni)
-                                log("next index:", pformat(self.next_index))
-                            else:
-                                self.next_index[_node] -= 1
-
-                    self.net.rpc(node, {
+            # Followers at the same next index get the same entries, so we
+            # serialize each distinct payload once and splice the encoded
+            # bytes into every envelope that shares it.
+            heartbeat_due = self.heartbeat_interval < elapsed_time
+            if heartbeat_due:
+                # Anything still unanswered after a whole heartbeat interval
+                # is presumed lost; drop its callbacks too, so a reply that
+                # never comes can't hold the callback list's head in place.
+                self.net.expire_callbacks()
+            wire_cache = {}
+            for i, node in enumerate(self.other_nodes()):
+                if heartbeat_due:
+                    # Anything still unanswered after a whole heartbeat
+                    # interval is presumed lost; start fresh.
+                    self.inflight[i] = 0
+                elif MAX_INFLIGHT_APPENDS <= self.inflight[i]:
+                    # This node has enough appends in flight already
+                    continue
+
+                # What entries should we send this node? Slicing and
+                # serializing the log tail happens once per distinct next
+                # index; other followers at the same spot reuse both.
+                ni = self.next_index[i]
+                cached = wire_cache.get(ni)
+                if cached is None:
+                    entries = self.log.from_index(ni)
+                    wire_entries = \
+                        Fragment(dumps(entries)) if Fragment else entries
+                    # One body dict serves every follower at this next
+                    # index: rpc() serializes it on the spot, overwriting
+                    # only msg_id between sends, so sharing it is safe.
+                    body = {
                         'type': 'append_entries',
                         'term': self.current_term,
                         'leader_id': self.node_id,
                         'prev_log_index': ni - 1,
-                        'prev_log_term': self.log.get(ni - 1)['term'],
-                        'entries': entries,
+                        'prev_log_term': self.log.term_at(ni - 1),
+                        'entries': wire_entries,
                         'leader_commit': self.commit_index
-                        }, handler)
+                        }
+                    cached = (entries, body)
+                    wire_cache[ni] = cached
+                else:
+                    entries, body = cached
+                if 0 < len(entries) or heartbeat_due:
+                    if LOG_LEVEL >= 2:
+                        log('replicating ' + str(ni) + '+ to', node)
+
+
+                    self.net.rpc(node, body,
+                                 self.handle_append_entries_res,
+                                 (i, ni, len(entries), node, term, self.now))
+                    self.inflight[i] += 1
+                    # Pipeline: optimistically advance past this batch so the
+                    # next pass sends fresh entries rather than waiting for
+                    # the ack; failure responses rewind next_index via the
+                    # conflict hints.
+                    self.next_index[i] = ni + len(entries)
                     replicated = True
 
         if replicated:
             # We did something!
-            self.last_replication = time.time()
+            self.last_replication = self.now
             return True
 
     # Message handlers
@@ -457,6 +734,10 @@ class RaftNode():
             body = msg['body']
             self.set_node_id(body['node_id'])
             self.node_ids = body['node_ids']
+            self._other_nodes = tuple(n for n in self.node_ids
+                                      if n != self.node_id)
+            self.peer_idx = {n: i for i, n in enumerate(self._other_nodes)}
+            self.quorum = majority(len(self.node_ids))
 
             self.become_follower()
 
@@ -468,23 +749,44 @@ class RaftNode():
         # When a node requests our vote...
         def request_vote(msg):
             body = msg['body']
-            self.maybe_step_down(body['term'])
+            term = body['term']
+            last_log_term = body['last_log_term']
+            last_log_index = body['last_log_index']
+            our_term = self.log.last_term()
+            our_size = self.log.size()
+
+            # Leader stickiness: if we've heard from a live leader within
+            # the last election timeout, ignore the candidacy outright--we
+            # don't even advance our term. This keeps a rejoining node from
+            # deposing a working leader, and it's what makes that leader's
+            # read lease sound.
+            if self.now < self.last_leader_contact + self.election_timeout:
+                log('heard from leader', self.leader, \
+                        'recently, not granting vote')
+                self.net.reply(msg, {
+                    'type': 'request_vote_res',
+                    'term': self.current_term,
+                    'vote_granted': False
+                    })
+                return
+
+            self.maybe_step_down(term)
             grant = False
 
-            if body['term'] < self.current_term:
-                log('candidate term', body['term'], 'lower than', \
+            if term < self.current_term:
+                log('candidate term', term, 'lower than', \
                         self.current_term, 'not granting vote')
             elif self.voted_for is not None:
                 log('already voted for', self.voted_for, 'not granting vote')
-            elif body['last_log_term'] < self.log.last()['term']:
-                log("have log entries from term", self.log.last()['term'], \
+            elif last_log_term < our_term:
+                log("have log entries from term", our_term, \
                         "which is newer than remote term", \
-                        body['last_log_term'], "not granting vote")
-            elif body['last_log_term'] == self.log.last()['term'] and \
-                    body['last_log_index'] < self.log.size():
-                log("Our logs are both at term", self.log.last()['term'], \
-                        "but our log is", self.log.size(), \
-                        "and theirs is only", body['last_log_index'])
+                        last_log_term, "not granting vote")
+            elif last_log_term == our_term and \
+                    last_log_index < our_size:
+                log("Our logs are both at term", our_term, \
+                        "but our log is", our_size, \
+                        "and theirs is only", last_log_index)
             else:
                 log("Granting vote to", msg['src'])
                 grant = True
@@ -501,7 +803,8 @@ class RaftNode():
         # When we're given entries by a leader
         def append_entries(msg):
             body = msg['body']
-            self.maybe_step_down(body['term'])
+            term = body['term']
+            self.maybe_step_down(term)
 
             res = {
                     'type': 'append_entries_res',
@@ -509,38 +812,51 @@ class RaftNode():
                     'success': False
                     }
 
-            if body['term'] < self.current_term:
+            if term < self.current_term:
                 # Leader is behind us
                 self.net.reply(msg, res)
                 return None
 
             # This leader is valid; remember them and don't try to run our own
-            # election for a bit
+            # election (or vote in anyone else's) for a bit
             self.leader = body['leader_id']
+            self.last_leader_contact = self.now
             self.reset_election_deadline()
 
             # Check previous entry to see if it matches
-            if body['prev_log_index'] <= 0:
+            pli = body['prev_log_index']
+            if pli <= 0:
                 raise RuntimeError("Out of bounds previous log index" + \
-                        str(body['prev_log_index']))
+                        str(pli))
 
-            try:
-                e = self.log.get(body['prev_log_index'])
-            except IndexError:
-                e = None
+            if self.log.size() < pli:
+                # We don't have that entry at all; tell the leader where our
+                # log ends so it can jump straight there.
+                res['conflict_index'] = self.log.size() + 1
+                self.net.reply(msg, res)
+                return None
 
-            if (not e) or e['term'] != body['prev_log_term']:
-                # We disagree on the previous term
+            prev_term = self.log.term_at(pli)
+            if prev_term != body['prev_log_term']:
+                # We disagree on the previous term. Report the first index we
+                # hold for that term, so the leader can skip the whole run of
+                # conflicting entries in one round trip.
+                ci = pli
+                while 1 < ci and self.log.term_at(ci - 1) == prev_term:
+                    ci -= 1
+                res['conflict_term'] = prev_term
+                res['conflict_index'] = ci
                 self.net.reply(msg, res)
                 return None
 
             # We agree on the previous log term; truncate and append
-            self.log.truncate(body['prev_log_index'])
+            self.log.truncate(pli)
             self.log.append(body['entries'])
 
             # Advance commit pointer
-            if self.commit_index < body['leader_commit']:
-                self.commit_index = min(body['leader_commit'], self.log.size(),)
+            leader_commit = body['leader_commit']
+            if self.commit_index < leader_commit:
+                self.commit_index = min(leader_commit, self.log.size())
 
             # Acknowledge
             res['success'] = True
@@ -551,10 +867,19 @@ class RaftNode():
         # Handle client KV requests
         def kv_req(msg):
             if self.state == 'leader':
-                # Record who we should tell about the completion of this op
                 op = msg['body']
                 op['client'] = msg['src']
-                self.log.append([{'term': self.current_term, 'op': op}])
+                if op['type'] == 'read' and self.lease_valid():
+                    # Under a valid lease no other leader can have committed
+                    # writes we haven't applied, so answer straight from the
+                    # state machine instead of paying a replication round.
+                    res = self.state_machine.apply(op)
+                    self.net.send(res['dest'], res['body'])
+                else:
+                    # Record who we should tell about the completion of this
+                    # op; it'll share a log entry with any others from this
+                    # tick.
+                    self.pending_ops.append(op)
             elif self.leader:
                 # We're not the leader, but we can proxy to one
                 msg['dest'] = self.leader
@@ -570,19 +895,43 @@ class RaftNode():
         self.net.on('write', kv_req)
         self.net.on('cas', kv_req)
 
+    def next_deadline(self):
+        """When's the next time we might have timer-driven work to do?"""
+        deadline = self.election_deadline
+        if self.state == 'leader':
+            deadline = min(deadline,
+                           self.step_down_deadline,
+                           self.last_replication +
+                           self.min_replication_interval)
+        return deadline
+
     def main(self):
         """Mainloop."""
         log('Online.')
 
+        # Rather than polling stdin and sleeping, we block in a selector
+        # until either input arrives or our next deadline comes due.
+        sel = selectors.DefaultSelector()
+        sel.register(sys.stdin, selectors.EVENT_READ)
+
         while True:
             try:
-                self.net.process_msg() or \
-                self.step_down_on_timeout() or \
-                self.replicate_log() or \
-                self.election() or \
-                self.advance_commit_index() or \
-                self.advance_state_machine() or \
-                time.sleep(0.001)
+                timeout = max(0, self.next_deadline() - self.now)
+                ready = sel.select(timeout)
+                # One clock reading per tick; every deadline predicate and
+                # reset in this iteration sees the same consistent now.
+                self.now = time.monotonic()
+                if ready:
+                    self.net.process_msg()
+
+                self.step_down_on_timeout()
+                self.append_pending_ops()
+                self.replicate_log()
+                self.election()
+                self.advance_commit_index()
+                self.advance_state_machine()
+
+                self.net.flush()
 
             except KeyboardInterrupt:
                 log("Aborted by interrupt!")
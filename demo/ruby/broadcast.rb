@@ -4,14 +4,19 @@
 # `broadcast` requests from clients.
 
 require_relative 'node.rb'
-require 'set'
 
 class BroadcastNode
   def initialize
     @node = Node.new
     @neighbors = []
     @lock = Mutex.new
-    @messages = Set.new
+    # Maelstrom's broadcast workload generates small non-negative ints, so
+    # we track membership as a bitset in a single Integer--one bit per
+    # message--and keep an ordered array for read replies.
+    @message_bits = 0
+    @messages = []
+    # Messages we've learned about but haven't gossiped to peers yet
+    @to_gossip = []
 
     @node.on "topology" do |msg|
       @neighbors = msg[:body][:topology][@node.node_id.to_sym]
@@ -22,28 +27,52 @@ class BroadcastNode
     @node.on "read" do |msg|
       @lock.synchronize do
         @node.reply! msg, {type: "read_ok",
-                           messages: @messages.to_a}
+                           messages: @messages}
       end
     end
 
     @node.on "broadcast" do |msg|
-      m = msg[:body][:message]
-      @lock.synchronize do
-        unless @messages.include? m
-          @messages.add m
-          @node.log "messages now #{@messages}"
+      record! [msg[:body][:message]]
+      @node.reply! msg, {type: "broadcast_ok"}
+    end
 
-          # Broadcast this message to neighbors (except whoever sent it to us)
-          @node.other_node_ids.each do |neighbor|
-            unless neighbor == msg[:src]
-              @node.rpc! neighbor, {type: "broadcast", message: m} do |res|
-                # Eh, whatever
-              end
-            end
+    # Batched gossip from a peer
+    @node.on "broadcast_many" do |msg|
+      record! msg[:body][:messages]
+      @node.reply! msg, {type: "broadcast_many_ok"}
+    end
+
+    # Rather than one RPC per neighbor per message, we accumulate new
+    # messages and gossip each batch in a single broadcast_many per peer.
+    # Receivers ignore messages they already have, which stops the gossip.
+    @node.every 0.2 do
+      batch = nil
+      @lock.synchronize do
+        batch = @to_gossip
+        @to_gossip = []
+      end
+      unless batch.empty?
+        @node.other_node_ids.each do |neighbor|
+          @node.rpc! neighbor, {type: "broadcast_many",
+                                messages: batch} do |res|
+            # Eh, whatever
           end
         end
       end
-      @node.reply! msg, {type: "broadcast_ok"}
+    end
+  end
+
+  # Adds messages to our set, queueing any we hadn't seen for gossip.
+  def record!(ms)
+    @lock.synchronize do
+      ms.each do |m|
+        if @message_bits[m] == 0
+          @message_bits |= (1 << m)
+          @messages << m
+          @to_gossip << m
+          @node.log "messages now #{@messages}"
+        end
+      end
     end
   end
 